@@ -1,14 +1,28 @@
 import os
+import queue
 import asyncio
 import sqlite3
 import secrets
+import threading
+import concurrent.futures
+from collections import OrderedDict, deque
+from typing import Optional
+import orjson
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, g, redirect, url_for, make_response, Response, render_template
+from flask import Flask, request, g, redirect, url_for, make_response, Response, render_template, stream_with_context
 # MODIFIED: Use DatabaseSessionService for persistent sessions
 from google.adk.sessions import DatabaseSessionService 
 from google.adk.runners import Runner
+from google.adk.agents.run_config import RunConfig, StreamingMode
+from google.adk.errors.already_exists_error import AlreadyExistsError
 from google.genai.types import Content, Part
 
+# uvloop is an optional, faster drop-in event loop (not available on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # NOTE: The 'instance.agent' module is assumed to be available in the execution environment.
 # Ensure 'instance/agent.py' exists and exports a 'root_agent' instance for this to work.
 try:
@@ -24,10 +38,51 @@ load_dotenv()
 # --- ADK Initialization & Global State ---
 APP_NAME = "agent_flask"
 USER_ID = "web_user" # Keeping a fixed user ID for this web demo
+MAX_SESSIONS = int(os.getenv("MAX_ADK_SESSIONS", "10000")) # Cap on sessions tracked in memory
+# Agent runs in flight at once per process. Each one holds a request thread for the whole run,
+# so gunicorn.conf.py sizes this below the worker's thread count.
+MAX_CONCURRENT_CHATS = int(os.getenv("MAX_CONCURRENT_CHATS", "64"))
+CHAT_TIMEOUT = float(os.getenv("CHAT_TIMEOUT", "120")) # Seconds a request waits for the agent
+# The per-session history maps are split into this many independently locked shards
+# (must be a power of two)
+SESSION_SHARDS = 16
+SHARD_MAX_SESSIONS = max(1, MAX_SESSIONS // SESSION_SHARDS)
 
 # --- Database Configuration ---
 DATABASE = 'history.db'
 DB_URL = os.getenv("SESSION_DB_URL", f"sqlite:///./{DATABASE}")
+# Set when several worker processes share history.db (gunicorn.conf.py exports WEB_CONCURRENCY)
+SHARED_HISTORY_DB = int(os.getenv("WEB_CONCURRENCY", "1")) > 1
+
+# In-memory copy of the session list, most recently active first.
+# Loaded from the database on first use and then kept current by save_message().
+# Writers publish a new immutable tuple under _snapshot_lock; readers take no lock.
+_sessions_snapshot: Optional[tuple[str, ...]] = None
+# Sessions written to while there is no snapshot yet, oldest first, so a session-list
+# query that was already running can merge in writes it may have missed.
+_pending_touches: list[str] = []
+_snapshot_lock = threading.Lock()
+
+# Per-session history state, sharded by session ID hash so requests for different
+# sessions rarely contend on the same lock. Each shard holds:
+#  - counts: number of stored messages for sessions whose history is known to this
+#    process, least recently used first (bounded by SHARD_MAX_SESSIONS). A count of 0
+#    lets /history answer without touching the database.
+#  - cache: last history loaded per session, keyed by the message count it was loaded at.
+#    History only grows, so an entry stays valid until the session's count moves on.
+_history_shards: list[tuple[OrderedDict[str, int], dict[str, tuple[int, list[dict]]], threading.Lock]] = [
+    (OrderedDict(), {}, threading.Lock()) for _ in range(SESSION_SHARDS)
+]
+# Messages stored per shard, tracked or not, so a history load can tell whether a write
+# to its shard landed while it ran. Guarded by the shard's lock.
+_history_write_seqs: list[int] = [0] * SESSION_SHARDS
+
+# The caches above are per process. When several workers share history.db, they are
+# dropped whenever SQLite's file change counter shows a commit since they were filled.
+# Each drop bumps _cache_generation, so loads that started before it are not cached.
+_cache_db_version: Optional[bytes] = None
+_cache_generation = 0
+_cache_version_lock = threading.Lock()
 
 # Initialize Flask App
 # Flask will look for templates in a 'templates' folder automatically
@@ -75,6 +130,8 @@ def save_message(session_id: str, role: str, text: str):
             (session_id, role, text)
         )
         db.commit()
+        _touch_session(session_id)
+        _bump_history_count(session_id)
     except Exception as e:
         app.logger.error(f"Database Save Error: {e}")
 
@@ -91,8 +148,124 @@ def load_history(session_id: str) -> list[dict]:
         app.logger.error(f"Database Load Error: {e}")
         return []
 
-def get_all_session_ids() -> list[str]:
-    """Loads all unique session IDs from the database."""
+def _history_db_version() -> bytes:
+    """
+    Returns SQLite's file change counter (bytes 24-27 of the database header),
+    which every committed write from any process increments.
+    """
+    try:
+        with open(DATABASE, 'rb') as f:
+            f.seek(24)
+            return f.read(4)
+    except OSError:
+        return b''
+
+def invalidate_stale_caches():
+    """
+    Drops the in-memory history caches if history.db was written since they were filled.
+    Only needed when other worker processes write to the database; a single process keeps
+    its caches current itself.
+    """
+    global _cache_db_version, _cache_generation, _sessions_snapshot
+    if not SHARED_HISTORY_DB:
+        return
+    with _cache_version_lock:
+        version = _history_db_version()
+        if version == _cache_db_version:
+            return
+        _cache_generation += 1
+        for counts, cache, lock in _history_shards:
+            with lock:
+                counts.clear()
+                cache.clear()
+        with _snapshot_lock:
+            _sessions_snapshot = None
+            _pending_touches.clear()
+        _cache_db_version = version
+
+def _history_shard_index(session_id: str) -> int:
+    """Returns the index of the shard holding a session's history state."""
+    return hash(session_id) & (SESSION_SHARDS - 1)
+
+def _history_shard(session_id: str):
+    """Returns the (counts, cache, lock) shard holding a session's history state."""
+    return _history_shards[_history_shard_index(session_id)]
+
+def _store_history_count(counts: OrderedDict, cache: dict, session_id: str, count: int):
+    """Records the number of stored messages for a session. Caller holds the shard's lock."""
+    counts[session_id] = count
+    counts.move_to_end(session_id)
+    if len(counts) > SHARD_MAX_SESSIONS:
+        evicted, _ = counts.popitem(last=False)
+        cache.pop(evicted, None)
+
+def _set_history_count(session_id: str, count: int):
+    """Records the number of stored messages for a session."""
+    counts, cache, lock = _history_shard(session_id)
+    with lock:
+        _store_history_count(counts, cache, session_id, count)
+
+def _bump_history_count(session_id: str):
+    """Counts a newly stored message, if the session's history is being tracked."""
+    shard = _history_shard_index(session_id)
+    counts, _, lock = _history_shards[shard]
+    with lock:
+        _history_write_seqs[shard] += 1
+        if session_id in counts:
+            counts[session_id] += 1
+
+def get_session_history(session_id: str) -> list[dict]:
+    """Returns a session's history, serving it from memory when nothing new was stored."""
+    shard = _history_shard_index(session_id)
+    counts, cache, lock = _history_shards[shard]
+    count = counts.get(session_id)
+    cached = cache.get(session_id)
+    if count == 0 or (cached is not None and cached[0] == count):
+        # Served from memory: refresh the session's recency so polled sessions stay cached
+        with lock:
+            if session_id in counts:
+                counts.move_to_end(session_id)
+        # A count of 0 is known to be empty, so the history query is skipped entirely
+        return [] if count == 0 else cached[1]
+
+    generation = _cache_generation
+    write_seq = _history_write_seqs[shard]
+    history = load_history(session_id)
+    if history:
+        with lock:
+            if generation != _cache_generation or write_seq != _history_write_seqs[shard]:
+                # The caches were dropped, or a message was stored, while this query ran;
+                # it may predate that write, so neither its count nor its rows are kept
+                return history
+            count = counts.get(session_id)
+            if count is None:
+                count = len(history)
+                _store_history_count(counts, cache, session_id, count)
+            # Only cache rows that agree with the tracked count
+            if count == len(history):
+                cache[session_id] = (count, history)
+    return history
+
+def _touch_session(session_id: str):
+    """Moves a session to the front of the cached session list."""
+    global _sessions_snapshot
+    with _snapshot_lock:
+        snapshot = _sessions_snapshot
+        if snapshot is None:
+            _pending_touches.append(session_id)
+            return
+        if snapshot and snapshot[0] == session_id:
+            return
+        _sessions_snapshot = (session_id,) + tuple(sid for sid in snapshot if sid != session_id)
+
+def get_all_session_ids() -> tuple[str, ...]:
+    """Returns all unique session IDs, most recently active first."""
+    global _sessions_snapshot
+    snapshot = _sessions_snapshot
+    if snapshot is not None:
+        return snapshot
+    generation = _cache_generation
+    touches_seen = len(_pending_touches)
     try:
         db = get_db()
         rows = db.execute(
@@ -108,10 +281,45 @@ def get_all_session_ids() -> list[str]:
             ORDER BY T2.max_timestamp DESC
             """
         ).fetchall()
-        return [row['session_id'] for row in rows]
+        session_ids = tuple(row['session_id'] for row in rows)
+        with _snapshot_lock:
+            if generation != _cache_generation:
+                # The caches were dropped while this query ran; don't publish its result
+                return session_ids
+            if _sessions_snapshot is None:
+                missed = _pending_touches[touches_seen:]
+                if missed:
+                    # Sessions written during the query go first, most recent first
+                    recent = tuple(dict.fromkeys(reversed(missed)))
+                    recent_set = set(recent)
+                    session_ids = recent + tuple(sid for sid in session_ids if sid not in recent_set)
+                _sessions_snapshot = session_ids
+                _pending_touches.clear()
+            return _sessions_snapshot
     except Exception as e:
         app.logger.error(f"Database Session Load Error: {e}")
-        return []
+        return ()
+
+
+# --- Background Event Loop ---
+# A single long-lived event loop runs in a daemon thread for the life of the process.
+# Request handlers submit coroutines to it instead of calling asyncio.run(), so the
+# loop (and any connection pools the ADK clients bind to it) is reused across requests.
+loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, name="adk-event-loop", daemon=True).start()
+
+# Bounds how many agent runs are in flight at once. A slot is taken without waiting on the
+# request thread, so chats beyond the limit are turned away instead of tying up more threads.
+_chat_slots = threading.BoundedSemaphore(MAX_CONCURRENT_CHATS)
+
+def submit_chat(coro) -> concurrent.futures.Future:
+    """
+    Schedules an agent run, which must already hold a chat slot, on the background event loop.
+    The slot is released when the run finishes, fails or is cancelled.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    future.add_done_callback(lambda _: _chat_slots.release())
+    return future
 
 
 # Initialize DatabaseSessionService using the consolidated DB_URL
@@ -119,7 +327,9 @@ session_service = DatabaseSessionService(db_url=DB_URL)
 
 # Create the runner with the agent only if root_agent was successfully imported
 runner = None
-adk_sessions = {} # Dictionary to track which sessions have been accessed since restart
+# Sessions accessed since restart, least recently used first (bounded by MAX_SESSIONS).
+# Only touched by coroutines on the background event loop, so it needs no lock.
+adk_sessions: OrderedDict[str, bool] = OrderedDict()
 
 if root_agent:
     runner = Runner(
@@ -128,48 +338,152 @@ if root_agent:
         session_service=session_service,
     )
 
+    # In-flight session initializations, so concurrent requests for the same new
+    # session share one create call. Only touched from the background event loop.
+    _init_tasks: dict[str, asyncio.Task] = {}
+
+    async def _create_adk_session(session_id: str):
+        """Creates the ADK session if needed and records it in adk_sessions."""
+        app.logger.info(f"Initializing ADK session check for {USER_ID}/{session_id}")
+        
+        try:
+            # Create first: a new session needs a single call, and an existing one is
+            # reported by AlreadyExistsError, which is all we need to know.
+            await session_service.create_session(
+                app_name=APP_NAME,
+                user_id=USER_ID,
+                session_id=session_id
+            )
+        except AlreadyExistsError:
+            pass
+        except Exception as e:
+            app.logger.error(f"DatabaseSessionService Initialization Error: {e}")
+            raise 
+        
+        adk_sessions[session_id] = True
+        if len(adk_sessions) > MAX_SESSIONS:
+            # Only the in-memory marker is dropped; the session itself stays in the
+            # database and is picked up again on its next access.
+            adk_sessions.popitem(last=False)
+
     async def initialize_adk_session(session_id: str):
         """
         Ensures the ADK session is accessible and created if it doesn't exist.
         The DatabaseSessionService handles loading persistent history.
         """
-        if session_id not in adk_sessions:
-            app.logger.info(f"Initializing ADK session check for {USER_ID}/{session_id}")
-            
-            try:
-                session = await session_service.get_session(
-                    app_name=APP_NAME, 
-                    user_id=USER_ID, 
-                    session_id=session_id
-                )
-                
-                if not session:
-                    await session_service.create_session(
-                        app_name=APP_NAME,
-                        user_id=USER_ID,
-                        session_id=session_id
-                    )
-
-            except Exception as e:
-                app.logger.error(f"DatabaseSessionService Initialization Error: {e}")
-                raise 
-            
-            adk_sessions[session_id] = True
+        if session_id in adk_sessions:
+            adk_sessions.move_to_end(session_id)
+            return
+
+        task = _init_tasks.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(_create_adk_session(session_id))
+            _init_tasks[session_id] = task
+            task.add_done_callback(lambda _: _init_tasks.pop(session_id, None))
+        # Shielded so a cancelled caller doesn't cancel the initialization other callers await
+        await asyncio.shield(task)
+
+    async def get_agent_response(msg, session_id):
+        """Asynchronously runs the agent and extracts the final text response."""
+        response = ""
+        event = None
+        try:
+            # Only the run's terminal event carries the final response, so intermediate
+            # events are drained without inspecting them
+            async for event in runner.run_async(
+                user_id=USER_ID,
+                session_id=session_id,
+                new_message=msg
+            ):
+                pass
+        except Exception as e:
+            # Handle potential ADK/Runner exceptions
+            return f"An agent error occurred: {str(e)}"
+
+        if event is not None and event.is_final_response():
+            content = event.content
+            if content and content.parts:
+                # Extract text from the first part of the content
+                response = content.parts[0].text
+        
+        return response
+
+    async def stream_agent_response(msg, session_id, chunks: queue.Queue):
+        """
+        Runs the agent with token streaming enabled, putting ("delta", text) items on the
+        queue as partial output arrives, then ("final", text) or ("error", text), then None.
+        """
+        try:
+            await initialize_adk_session(session_id)
+            final_text = ""
+            # The run is always iterated to completion rather than abandoned at the first
+            # final event, so ADK finishes (and persists) the turn in this task's context
+            async for event in runner.run_async(
+                user_id=USER_ID,
+                session_id=session_id,
+                new_message=msg,
+                run_config=RunConfig(streaming_mode=StreamingMode.SSE)
+            ):
+                content = getattr(event, "content", None)
+                if not (content and content.parts):
+                    continue
+                text = content.parts[0].text
+                if event.partial:
+                    if text:
+                        chunks.put(("delta", text))
+                elif event.is_final_response():
+                    final_text = text or ""
+            chunks.put(("final", final_text))
+        except Exception as e:
+            # Handle potential ADK/Runner exceptions
+            chunks.put(("error", f"An agent error occurred: {str(e)}"))
+        finally:
+            chunks.put(None)
+
+    async def handle_chat(session_id: str, msg):
+        """Ensures the ADK session exists, then runs the agent for a single message."""
+        await initialize_adk_session(session_id)
+        return await get_agent_response(msg, session_id)
 
 
 # --- Helper to get/create session ID from request ---
+SESSION_ID_POOL_SIZE = 1024
+_session_id_pool: deque[str] = deque()
+_session_id_pool_lock = threading.Lock()
+
+def new_session_id() -> str:
+    """
+    Returns a new, short, URL-safe session ID (e.g., 'a3b7c4d8').
+    IDs are cut from one large entropy draw per SESSION_ID_POOL_SIZE sessions,
+    so most calls are a deque pop rather than a read from the OS random source.
+    """
+    while True:
+        try:
+            return _session_id_pool.popleft()
+        except IndexError:
+            with _session_id_pool_lock:
+                if not _session_id_pool:
+                    entropy = secrets.token_hex(4 * SESSION_ID_POOL_SIZE)
+                    _session_id_pool.extend(entropy[i:i + 8] for i in range(0, len(entropy), 8))
+
 def get_or_create_session_id():
     """Gets the session ID from the request or generates a new one."""
     session_id = request.args.get('session_id')
     if not session_id:
         # Generate a new, short, URL-safe session ID (e.g., 'a3b7c4d8')
-        session_id = secrets.token_hex(4)
+        session_id = new_session_id()
+        # A freshly generated session has no history yet
+        _set_history_count(session_id, 0)
         # Redirect to the new URL with the session_id query parameter
         return redirect(url_for('index', session_id=session_id))
     return session_id
 
 # --- API Endpoints ---
 
+def ojson(payload, status: int = 200) -> Response:
+    """Builds a JSON response encoded with orjson."""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
 @app.route('/history', methods=['GET'])
 def get_history_api():
     """Returns the chat history and all sessions for the current session ID."""
@@ -177,12 +491,13 @@ def get_history_api():
     if not current_session_id:
         # Return an empty set if no session ID is provided, but this shouldn't happen 
         # as the index route should always ensure one is present.
-        return jsonify({"history": [], "sessions": []}), 200
+        return ojson({"history": [], "sessions": []})
 
-    history = load_history(current_session_id)
+    invalidate_stale_caches()
+    history = get_session_history(current_session_id)
     sessions = get_all_session_ids()
     
-    return jsonify({
+    return ojson({
         "history": history,
         "current_session_id": current_session_id,
         "sessions": sessions
@@ -193,56 +508,77 @@ def chat():
     """Handles incoming user messages, runs the ADK agent, and returns the response."""
     current_session_id = request.args.get('session_id')
     if not current_session_id:
-        return jsonify({"response": "Error: Session ID is missing."}), 400
+        return ojson({"response": "Error: Session ID is missing."}, 400)
 
     if not runner:
-        return jsonify({"response": "Error: Agent runner is not initialized. Check server logs."}), 500
+        return ojson({"response": "Error: Agent runner is not initialized. Check server logs."}, 500)
 
-    # Ensure the ADK session is initialized/loaded from the database
-    if root_agent and current_session_id not in adk_sessions:
-        try:
-            # Synchronously call the async session initializer
-            asyncio.run(initialize_adk_session(current_session_id))
-        except Exception as e:
-            app.logger.error(f"ADK Session Initialization Error: {e}")
-            return jsonify({"response": f"ADK Session Init Error: {str(e)}"}), 500
-
-    data = request.get_json()
-    user_input = data.get('message', '').strip()
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = None
+    user_input = data.get('message', '') if isinstance(data, dict) else ''
+    if not isinstance(user_input, str):
+        user_input = ''
+    # Most messages have no surrounding whitespace, so only strip when there is some
+    if user_input and (user_input[0].isspace() or user_input[-1].isspace()):
+        user_input = user_input.strip()
 
     if not user_input:
-        return jsonify({"response": "Please provide a message."}), 400
+        return ojson({"response": "Please provide a message."}, 400)
+
+    if not _chat_slots.acquire(blocking=False):
+        return ojson({"response": "The agent is busy with other chats. Please try again in a moment."}, 503)
 
     # 1. Save user message to UI history DB (history.db)
     save_message(current_session_id, "user", user_input)
 
-    # Prepare the message for the runner
-    message = Content(role="user", parts=[Part(text=user_input)])
+    # Prepare the message for the runner. The fields are built here from a plain str,
+    # so pydantic validation is skipped.
+    message = Content.model_construct(role="user", parts=[Part.model_construct(text=user_input)])
 
-    response_text = "Sorry, I encountered an internal error."
+    if request.accept_mimetypes.best == 'text/event-stream':
+        # Stream the response as Server-Sent Events while the agent is still generating it
+        chunks = queue.Queue()
+        agent_run = submit_chat(stream_agent_response(message, current_session_id, chunks))
 
-    async def get_agent_response(msg, session_id):
-        """Asynchronously runs the agent and extracts the final text response."""
-        response = ""
-        try:
-            async for event in runner.run_async(
-                user_id=USER_ID,
-                session_id=session_id,
-                new_message=msg
-            ):
-                if hasattr(event, "is_final_response") and event.is_final_response():
-                    if hasattr(event, "content") and event.content.parts:
-                        # Extract text from the first part of the content
-                        response = event.content.parts[0].text
+        def generate_events():
+            finished = False
+            try:
+                while True:
+                    try:
+                        item = chunks.get(timeout=CHAT_TIMEOUT)
+                    except queue.Empty:
+                        agent_run.cancel()
+                        item = ("error", "The agent took too long to respond.")
+                    if item is None:
                         break
-        except Exception as e:
-            # Handle potential ADK/Runner exceptions
-            return f"An agent error occurred: {str(e)}"
-        
-        return response
+                    kind, text = item
+                    if kind == "final":
+                        # 2. Save agent message to UI history DB (history.db) on success
+                        save_message(current_session_id, "agent", text)
+                    finished = kind in ("final", "error")
+                    yield b"data: " + orjson.dumps({"type": kind, "text": text}) + b"\n\n"
+                    if kind == "error":
+                        break
+            finally:
+                if not finished:
+                    # The client went away mid-answer (reload, navigation): stop the run so it
+                    # frees its chat slot instead of producing a reply nobody will record
+                    agent_run.cancel()
+
+        return Response(
+            stream_with_context(generate_events()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache'}
+        )
 
+    response_text = "Sorry, I encountered an internal error."
+
+    # Session initialization and the agent run share a single trip to the event loop
+    agent_run = submit_chat(handle_chat(current_session_id, message))
     try:
-        final_response = asyncio.run(get_agent_response(message, current_session_id))
+        final_response = agent_run.result(CHAT_TIMEOUT)
         
         if final_response.startswith("An agent error occurred"):
             response_text = final_response
@@ -254,11 +590,16 @@ def chat():
             # 2. Save agent message to UI history DB (history.db) on success
             save_message(current_session_id, "agent", response_text)
 
+    except concurrent.futures.TimeoutError:
+        agent_run.cancel()
+        response_text = "The agent took too long to respond."
+        status_code = 504
+
     except Exception as e:
         response_text = f"Flask runtime error: {str(e)}"
         status_code = 500
         
-    return jsonify({"response": response_text}), status_code
+    return ojson({"response": response_text}, status_code)
 
 
 @app.route('/')
@@ -277,9 +618,12 @@ def index():
     # 2. Render the index.html template, passing the current session ID
     return render_template('index.html', current_session_id=current_session_id)
 
+# Initialize the database on import, so it also happens under gunicorn (see gunicorn.conf.py)
+init_db()
+
 # --- Run the Flask App ---
 if __name__ == "__main__":
-    # Initialize database when the application starts
-    init_db()
     # To run this file, you'll need the required dependencies and instance/agent.py
+    # The dev server handles each request on its own thread; their agent runs are multiplexed
+    # on the shared background event loop rather than each spinning up a loop of its own.
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,25 @@
+# Gunicorn settings, loaded automatically by: gunicorn app:app
+import os
+import multiprocessing
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# One worker process per core. Each worker imports app.py on its own (no preload_app),
+# so every process gets its own background event loop and ADK runner.
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+# Threads within a worker block on the agent while the event loop multiplexes their runs
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# Keep worker heartbeat files in memory so a slow disk can't stall them
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+def on_starting(server):
+    """Exports settings app.py derives from the effective config (including CLI overrides)."""
+    # app.py reads this to decide whether other workers share history.db with it
+    os.environ["WEB_CONCURRENCY"] = str(server.cfg.workers)
+    # A chat holds its request thread for the whole agent run, so cap chats below the
+    # thread count and keep two threads per worker free for page loads and /history
+    os.environ.setdefault("MAX_CONCURRENT_CHATS", str(max(1, server.cfg.threads - 2)))